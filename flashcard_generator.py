@@ -2,15 +2,34 @@
 """Generate Anki flashcards from PDF sections using Claude API."""
 
 import argparse
+import concurrent.futures
 import csv
+import functools
+import hashlib
 import json
 import os
 import re
 import sys
+import tempfile
+import threading
+from pathlib import Path
 
 import anthropic
+import httpx
+import numpy as np
 import pymupdf
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 
 SYSTEM_PROMPT = """You are an expert flashcard creator. Your task is to generate high-quality Anki flashcards from the provided text.
 
@@ -21,7 +40,12 @@ Rules:
 - Avoid yes/no questions. Prefer "what", "how", "why", "explain" questions.
 - Cover the most important concepts, definitions, formulas, and relationships.
 - Do not create trivial or overly obvious cards.
-- Output ONLY a JSON array of objects with "front" and "back" keys. No other text."""
+- Output ONLY JSON in the requested format, with "front" and "back" keys on each flashcard. No other text."""
+
+# Marked for server-side prompt caching so repeated requests bill the prefix as cache reads.
+# Must stay byte-identical across calls; prefixes under the model's minimum cacheable
+# length are simply processed uncached.
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
 
 USER_PROMPT_TEMPLATE = """Create flashcards from this section titled "{title}":
 
@@ -29,12 +53,60 @@ USER_PROMPT_TEMPLATE = """Create flashcards from this section titled "{title}":
 
 Return a JSON array of flashcard objects, each with "front" and "back" keys."""
 
-MAX_SECTION_CHARS = 80_000
-CHUNK_OVERLAP = 2_000
+BATCH_PROMPT_TEMPLATE = """Create flashcards from each of the following {count} sections:
+
+{sections}
+
+Return a JSON object that maps each section number (as a string, e.g. "1") to a JSON array of flashcard objects \
+for that section, each with "front" and "back" keys."""
+
+BATCH_SECTION_TEMPLATE = """### Section {number}: "{title}"
+
+{text}"""
 
+_TAG_INVALID_RE = re.compile(r"[^\w\-]")
+_TAG_COLLAPSE_RE = re.compile(r"_+")
+_SECTION_KEY_RE = re.compile(r'\s*,?\s*"(\d+)"\s*:\s*')
 
-def extract_sections_from_toc(doc: pymupdf.Document) -> list[dict]:
+# Chunks are sized in Claude tokens. Each chunk gets MAX_TOKENS of output, so 20k tokens
+# (about 80k characters of English prose) keeps the card budget per unit of text;
+# larger chunks mean fewer requests but proportionally fewer cards
+MAX_CHUNK_TOKENS = 20_000
+CHUNK_OVERLAP_TOKENS = 1_000
+# Assumed when the SDK can't count tokens; token-dense text (CJK, code) can approach one token per character
+FALLBACK_CHARS_PER_TOKEN = 1.0
+MAX_PACK_CHARS = 8_000
+MAX_TOKENS = 4096
+DEFAULT_CONCURRENCY = 4
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 120.0
+MAX_KEEPALIVE_CONNECTIONS = 32
+MAX_CONNECTIONS = 64
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "anki_flashcards"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_WINDOW_CHARS = 1_000
+DEFAULT_SEMANTIC_THRESHOLD = 0.87
+# Fraction of embedding windows that must match for a semantic cache hit
+SEMANTIC_WINDOW_MATCH = 0.9
+SUGGESTED_DEDUPE_THRESHOLD = 0.95
+
+# Plain text extraction: join hyphenated line breaks and skip image extraction
+TEXT_FLAGS = pymupdf.TEXT_DEHYPHENATE | pymupdf.TEXT_MEDIABOX_CLIP
+
+
+def _page_text(doc: pymupdf.Document, page_texts: dict[int, str], pg: int) -> str:
+    """Return the plain text of page pg, extracting each page at most once."""
+    text = page_texts.get(pg)
+    if text is None:
+        text = page_texts[pg] = doc[pg].get_text("text", flags=TEXT_FLAGS)
+    return text
+
+
+def extract_sections_from_toc(doc: pymupdf.Document, page_texts: dict[int, str] | None = None) -> list[dict]:
     """Extract sections using the PDF's table of contents."""
+    if page_texts is None:
+        page_texts = {}
+
     toc = doc.get_toc()
     if not toc:
         return []
@@ -48,153 +120,742 @@ def extract_sections_from_toc(doc: pymupdf.Document) -> list[dict]:
         else:
             end_page = len(doc)
 
-        text = ""
-        for pg in range(max(0, start_page), min(end_page, len(doc))):
-            text += doc[pg].get_text()
-
-        text = text.strip()
+        parts = [
+            _page_text(doc, page_texts, pg)
+            for pg in range(max(0, start_page), min(end_page, len(doc)))
+        ]
+        text = "".join(parts).strip()
         if text:
             sections.append({"title": title.strip(), "text": text})
 
     return sections
 
 
-def extract_sections_by_font_size(doc: pymupdf.Document) -> list[dict]:
-    """Fallback: detect headings by font size heuristics."""
-    all_spans = []
-    for page in doc:
-        blocks = page.get_text("dict")["blocks"]
-        for block in blocks:
-            for line in block.get("lines", []):
-                for span in line.get("spans", []):
-                    if span["text"].strip():
-                        all_spans.append(span)
+def extract_sections_by_font_size(doc: pymupdf.Document, page_texts: dict[int, str] | None = None) -> list[dict]:
+    """Fallback: detect headings by font size heuristics.
+
+    The plain text of every page is recorded in page_texts as a by-product,
+    so later passes don't have to parse the pages again.
+    """
+    if page_texts is None:
+        page_texts = {}
 
-    if not all_spans:
+    sizes = []
+    texts = []
+    for pg, page in enumerate(doc):
+        blocks = page.get_text("dict", flags=TEXT_FLAGS)["blocks"]
+        page_lines = []
+        for block in blocks:
+            for line in block.get("lines", ()):
+                spans = line["spans"]
+                # Same layout as get_text("text"): one line of joined spans per text line
+                page_lines.append("".join(span["text"] for span in spans) + "\n")
+                for span in spans:
+                    text = span["text"].strip()
+                    if text:
+                        sizes.append(span["size"])
+                        texts.append(text)
+        page_texts[pg] = "".join(page_lines)
+
+    if not texts:
         return []
 
     # Find the median font size to identify headings (larger than median)
-    sizes = [s["size"] for s in all_spans]
-    sizes.sort()
-    median_size = sizes[len(sizes) // 2]
+    sizes = np.asarray(sizes, dtype=np.float64)
+    mid = len(sizes) // 2
+    median_size = float(np.partition(sizes, mid)[mid])
     heading_threshold = median_size * 1.2
 
-    sections = []
-    current_title = "Introduction"
-    current_text = []
-
-    for span in all_spans:
-        text = span["text"].strip()
-        if span["size"] >= heading_threshold and len(text) < 200:
-            # This looks like a heading
-            if current_text:
-                sections.append({
-                    "title": current_title,
-                    "text": "\n".join(current_text),
-                })
-            current_title = text
-            current_text = []
-        else:
-            current_text.append(text)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    heading_indices = np.flatnonzero((sizes >= heading_threshold) & (lengths < 200)).tolist()
 
-    # Don't forget the last section
-    if current_text:
-        sections.append({
-            "title": current_title,
-            "text": "\n".join(current_text),
-        })
+    # Each heading titles the spans up to the next heading; headings with no text are dropped
+    sections = []
+    starts = [-1] + heading_indices
+    ends = heading_indices + [len(texts)]
+    for heading, end in zip(starts, ends):
+        if end > heading + 1:
+            sections.append({
+                "title": texts[heading] if heading >= 0 else "Introduction",
+                "text": "\n".join(texts[heading + 1:end]),
+            })
 
     return sections
 
 
 def extract_sections(pdf_path: str) -> list[dict]:
     """Extract titled sections from a PDF file."""
-    doc = pymupdf.open(pdf_path)
+    with pymupdf.open(pdf_path) as doc:
+        # Page text recorded by earlier passes is reused by the last-resort pass
+        page_texts = {}
 
-    sections = extract_sections_from_toc(doc)
-    if not sections:
-        print("No table of contents found, detecting headings by font size...")
-        sections = extract_sections_by_font_size(doc)
+        sections = extract_sections_from_toc(doc, page_texts)
+        if not sections:
+            print("No table of contents found, detecting headings by font size...")
+            sections = extract_sections_by_font_size(doc, page_texts)
 
-    if not sections:
-        # Last resort: treat entire document as one section
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        sections = [{"title": "Full Document", "text": text.strip()}]
+        if not sections:
+            # Last resort: treat entire document as one section. The font-size pass has
+            # recorded every page by now, so no page is parsed again.
+            text = "".join(_page_text(doc, page_texts, pg) for pg in range(len(doc)))
+            sections = [{"title": "Full Document", "text": text.strip()}]
 
-    doc.close()
     return sections
 
 
-def chunk_text(text: str, max_chars: int = MAX_SECTION_CHARS, overlap: int = CHUNK_OVERLAP) -> list[str]:
-    """Split text into overlapping chunks if it exceeds max_chars."""
+def _token_len(client: anthropic.Anthropic, model: str, text: str, cache_dir: Path | None = None) -> int | None:
+    """Count the Claude tokens in text, or None if the SDK can't count tokens.
+
+    Counts are stored in cache_dir, so a re-run splits the same text at the
+    same places (and hits the response cache) without calling the API.
+    API errors are raised rather than guessed around for the same reason.
+    """
+    if cache_dir:
+        key = hashlib.sha256(json.dumps(["count_tokens", model, text]).encode("utf-8")).hexdigest()
+        cached = _cache_get(cache_dir, key)
+        if cached is not None:
+            return cached["input_tokens"]
+
+    if not hasattr(client.messages, "count_tokens"):
+        return None
+    result = client.messages.count_tokens(model=model, messages=[{"role": "user", "content": text}])
+
+    if cache_dir:
+        _cache_put(cache_dir, key, {"input_tokens": result.input_tokens})
+    return result.input_tokens
+
+
+def chunk_text_by_tokens(client: anthropic.Anthropic, model: str, text: str, max_tokens: int = MAX_CHUNK_TOKENS,
+                         overlap_tokens: int = CHUNK_OVERLAP_TOKENS, cache_dir: Path | None = None) -> list[str]:
+    """Split text into overlapping chunks of at most max_tokens Claude tokens.
+
+    Chunk sizes come from the text's measured characters-per-token ratio.
+    Each chunk is then counted again and split further if it is still too
+    long, since token density varies within a text (prose vs. code or tables).
+    """
+    # Short enough to fit even at the worst-case density assumed without counting
+    if len(text) <= max_tokens * FALLBACK_CHARS_PER_TOKEN:
+        return [text]
+
+    tokens = _token_len(client, model, text, cache_dir)
+    if tokens is None:
+        return chunk_text(
+            text, int(max_tokens * FALLBACK_CHARS_PER_TOKEN), int(overlap_tokens * FALLBACK_CHARS_PER_TOKEN),
+        )
+    if tokens <= max_tokens:
+        return [text]
+
+    chars_per_token = len(text) / tokens
+    chunks = []
+    for chunk in chunk_text(text, int(max_tokens * chars_per_token), int(overlap_tokens * chars_per_token)):
+        chunks.extend(chunk_text_by_tokens(client, model, chunk, max_tokens, overlap_tokens, cache_dir))
+    return chunks
+
+
+def chunk_text(text: str, max_chars: int, overlap: int) -> list[str]:
+    """Split text into overlapping chunks if it exceeds max_chars.
+
+    Chunks end at the last paragraph break in the back half of the window,
+    falling back to the last sentence end and then to a hard cut.
+    """
     if len(text) <= max_chars:
         return [text]
 
     chunks = []
     start = 0
-    while start < len(text):
+    while start + max_chars < len(text):
         end = start + max_chars
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start = end - overlap
+        earliest = start + max_chars // 2
+        cut = text.rfind("\n\n", earliest, end)
+        if cut == -1:
+            cut = text.rfind(". ", earliest, end)
+            cut = end if cut == -1 else cut + 1
+        chunks.append(text[start:cut])
+        start = max(cut - overlap, start + 1)
+    chunks.append(text[start:])
     return chunks
 
 
-def generate_flashcards(client: anthropic.Anthropic, model: str, title: str, text: str, max_cards: int | None) -> list[dict]:
-    """Send a section to Claude and parse flashcard JSON response."""
-    chunks = chunk_text(text)
-    all_cards = []
+def _cache_key(model: str, prompt: str) -> str:
+    """Hash everything that determines Claude's response into a cache key."""
+    payload = json.dumps([model, SYSTEM_PROMPT, prompt, MAX_TOKENS])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_get(cache_dir: Path, key: str) -> dict | None:
+    """Return the cached entry for key, or None on a miss."""
+    try:
+        with open(cache_dir / f"{key}.json", "rb") as f:
+            return json_loads(f.read())
+    except (OSError, json.JSONDecodeError):
+        return None
+
 
-    for i, chunk in enumerate(chunks):
-        chunk_title = title if len(chunks) == 1 else f"{title} (part {i + 1}/{len(chunks)})"
+def _write_atomic(path: Path, write):
+    """Write a file through a temp file and os.replace so readers never see partial files."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _cache_put(cache_dir: Path, key: str, value: dict):
+    """Store an entry atomically; failures only cost the cache, never the run."""
+    try:
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        _write_atomic(cache_dir / f"{key}.json", lambda f: f.write(data))
+    except (OSError, TypeError, ValueError) as e:
+        print(f"  Warning: Could not write cache entry to {cache_dir}: {e}")
+
+
+@functools.lru_cache(maxsize=1)
+def _load_encoder():
+    """Load the sentence embedding model once and share it."""
+    # Optional dependency, only needed for the semantic cache and near-duplicate detection
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
+
+class SemanticCache:
+    """Reuse flashcards generated for near-identical text, matched by embedding similarity.
+
+    Text is embedded in fixed-size windows, since the encoder truncates long
+    inputs. Two texts match when nearly all windows of each have a counterpart
+    in the other at or above the similarity threshold, so long chunks are
+    compared on their full content rather than on an averaged embedding.
+    Cards generated under a card limit are only reused for the same or a
+    lower limit.
+    """
+
+    def __init__(self, cache_dir: Path, threshold: float = DEFAULT_SEMANTIC_THRESHOLD):
+        self._encoder = _load_encoder()
+        self._path = cache_dir / "semantic.npz"
+        self._threshold = threshold
+        self._lock = threading.Lock()
+        self._embeddings = np.empty((0, self._encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._entries = []
+
+        try:
+            with np.load(self._path) as data:
+                embeddings = data["embeddings"]
+                entries = json.loads(str(data["entries"]))
+        except (OSError, KeyError, ValueError):
+            entries = []
+        consistent = all("max_cards" in entry for entry in entries)
+        if entries and consistent and sum(entry["windows"] for entry in entries) == len(embeddings):
+            self._embeddings = embeddings
+            self._entries = entries
+        elif entries:
+            print(f"Warning: Ignoring inconsistent semantic cache at {self._path}.")
+        self._offsets = np.cumsum([0] + [entry["windows"] for entry in self._entries])
+
+    def _embed(self, text: str):
+        """Embed text as one normalized vector per EMBED_WINDOW_CHARS window."""
+        windows = [text[i:i + EMBED_WINDOW_CHARS] for i in range(0, len(text), EMBED_WINDOW_CHARS)] or [""]
+        vectors = self._encoder.encode(windows, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32)
+
+    def lookup(self, model: str, text: str, max_cards: int | None = None) -> list[dict] | None:
+        """Return cached cards for the best-matching text, if it matches closely enough."""
+        query = self._embed(text)
+        best_score = SEMANTIC_WINDOW_MATCH
+        best_cards = None
+        with self._lock:
+            for i, entry in enumerate(self._entries):
+                # Texts of very different length can't be near-duplicates
+                if entry["model"] != model or not 0.8 <= entry["windows"] / len(query) <= 1.25:
+                    continue
+                # Cards cut off at a lower limit would silently cap a higher one
+                limit = entry["max_cards"]
+                if limit is not None and (not max_cards or limit < max_cards):
+                    continue
+                sims = self._embeddings[self._offsets[i]:self._offsets[i + 1]] @ query.T
+                # Fraction of windows on each side with a close counterpart on the other
+                score = min(
+                    float((sims.max(axis=0) >= self._threshold).mean()),
+                    float((sims.max(axis=1) >= self._threshold).mean()),
+                )
+                if score >= best_score:
+                    best_score = score
+                    best_cards = entry["cards"]
+        if best_cards is None:
+            return None
+        return [dict(card) for card in best_cards]
+
+    def add(self, model: str, text: str, cards: list[dict], max_cards: int | None = None):
+        """Record the cards generated for text under the given card limit."""
+        windows = self._embed(text)
+        # Copy, so later changes to the caller's cards (e.g. tags) aren't persisted
+        entry = {
+            "model": model,
+            "max_cards": max_cards or None,
+            "windows": len(windows),
+            "cards": [dict(card) for card in cards],
+        }
+        with self._lock:
+            self._embeddings = np.vstack([self._embeddings, windows])
+            self._entries.append(entry)
+            self._offsets = np.append(self._offsets, self._offsets[-1] + len(windows))
+
+    def save(self):
+        """Persist the embeddings and their entries to disk as a single file."""
+        with self._lock:
+            entries = np.array(json.dumps(self._entries, ensure_ascii=False))
+            try:
+                _write_atomic(self._path, lambda f: np.savez(f, embeddings=self._embeddings, entries=entries))
+            except OSError as e:
+                print(f"Warning: Could not save the semantic cache to {self._path}: {e}")
+
+
+class CardStreamParser:
+    """Incrementally extract flashcard objects from a streamed JSON array.
+
+    Tracks brace depth and string/escape state across deltas, so each object
+    is decoded exactly once, as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self.cards = []
+        self.invalid = 0
+        self._in_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current = []
+
+    def feed(self, delta: str) -> list[dict]:
+        """Consume a text delta and return the cards completed by it."""
+        new_cards = []
+        for ch in delta:
+            if self._done:
+                break
 
+            if self._depth == 0:
+                if not self._in_array:
+                    self._in_array = ch == "["
+                elif ch == "{":
+                    self._depth = 1
+                    self._current = [ch]
+                elif ch == "]":
+                    # A bracketed aside in leading prose is not the card array
+                    self._done = bool(self.cards or self.invalid)
+                    self._in_array = False
+                continue
+
+            self._current.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        card = json_loads("".join(self._current))
+                    except json.JSONDecodeError:
+                        self.invalid += 1
+                    else:
+                        self.cards.append(card)
+                        new_cards.append(card)
+        return new_cards
+
+
+def _match_json(s: str, start: int) -> int | None:
+    """Return the index just past the bracket that closes the one at s[start], or None if unclosed.
+
+    A single linear scan that respects string escapes, so brackets inside
+    card text don't cut the value short.
+    """
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(s)):
+        ch = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "[{":
+            depth += 1
+        elif ch in "]}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def _find_json(s: str, opener: str, first_chars: str) -> str | None:
+    """Return the first JSON value opened by opener in s, matched by bracket depth.
+
+    Candidates whose first non-space character is not in first_chars are
+    treated as prose and skipped, as are brackets in surrounding prose.
+    """
+    start = s.find(opener)
+    while start != -1:
+        j = start + 1
+        while j < len(s) and s[j].isspace():
+            j += 1
+        if j < len(s) and s[j] in first_chars:
+            end = _match_json(s, start)
+            return None if end is None else s[start:end]
+        start = s.find(opener, start + 1)
+    return None
+
+
+def _find_json_array(s: str) -> str | None:
+    """Return the first JSON array of objects in s."""
+    return _find_json(s, "[", "{]")
+
+
+def _find_json_object(s: str) -> str | None:
+    """Return the first JSON object in s."""
+    return _find_json(s, "{", '"}')
+
+
+def _pack_sections(sections: list[dict], max_chars: int = MAX_PACK_CHARS) -> list[list[int]]:
+    """Greedily group consecutive sections whose combined text fits in max_chars.
+
+    Returns lists of section indices; sections larger than max_chars stay on
+    their own so they go through the regular chunking path.
+    """
+    packs = []
+    current = []
+    current_chars = 0
+    for i, section in enumerate(sections):
+        size = len(section["text"])
+        if current and current_chars + size > max_chars:
+            packs.append(current)
+            current = []
+            current_chars = 0
+        current.append(i)
+        current_chars += size
+    if current:
+        packs.append(current)
+    return packs
+
+
+class CardDeduplicator:
+    """Drop cards whose question repeats one that was already kept.
+
+    Exact repeats are matched on the normalized front text. With a threshold,
+    fronts whose embedding is at least that similar to a kept front are
+    dropped as well.
+    """
+
+    def __init__(self, threshold: float | None = None):
+        self._seen = set()
+        self._threshold = threshold
+        if threshold is not None:
+            self._encoder = _load_encoder()
+            self._vectors = np.empty((0, self._encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    def filter(self, cards: list[dict]) -> list[dict]:
+        """Return the cards that are not duplicates of previously kept cards."""
+        unique = []
+        for card in cards:
+            key = hashlib.sha256(card["front"].lower().strip().encode("utf-8")).digest()
+            if key not in self._seen:
+                self._seen.add(key)
+                unique.append(card)
+
+        if self._threshold is None or not unique:
+            return unique
+
+        vectors = self._encoder.encode(
+            [card["front"] for card in unique], normalize_embeddings=True, convert_to_numpy=True,
+        ).astype(np.float32)
+        kept = []
+        kept_vectors = []
+        for card, vector in zip(unique, vectors):
+            if self._vectors.size and (self._vectors @ vector).max() >= self._threshold:
+                continue
+            if kept_vectors and (np.asarray(kept_vectors) @ vector).max() >= self._threshold:
+                continue
+            kept.append(card)
+            kept_vectors.append(vector)
+
+        if kept_vectors:
+            self._vectors = np.vstack([self._vectors, kept_vectors])
+        return kept
+
+
+def generate_chunk_flashcards(client: anthropic.Anthropic, model: str, chunk_title: str, prompt: str,
+                              cache_dir: Path | None = None, max_cards: int | None = None,
+                              semantic_cache: SemanticCache | None = None,
+                              source_text: str | None = None) -> list[dict]:
+    """Stream a single prompt to Claude and parse flashcards as they arrive.
+
+    An exact cache hit on the prompt wins over a semantic cache hit on source_text.
+    """
+    if cache_dir:
+        key = _cache_key(model, prompt)
+        cached = _cache_get(cache_dir, key)
+        if cached is not None:
+            return cached["cards"]
+
+    if semantic_cache and source_text is not None:
+        cards = semantic_cache.lookup(model, source_text, max_cards)
+        if cards is not None:
+            return cards[:max_cards] if max_cards else cards
+
+    parser = CardStreamParser()
+    text_parts = []
+    stop_reason = None
+    with client.messages.stream(
+        model=model,
+        max_tokens=MAX_TOKENS,
+        system=SYSTEM_BLOCKS,
+        messages=[{"role": "user", "content": prompt}],
+    ) as stream:
+        for delta in stream.text_stream:
+            text_parts.append(delta)
+            parser.feed(delta)
+            # Stop generating once the requested number of cards has arrived
+            if max_cards and len(parser.cards) >= max_cards:
+                break
+        else:
+            stop_reason = stream.get_final_message().stop_reason
+
+    if stop_reason == "max_tokens":
+        print(f"  Warning: Response for '{chunk_title}' was truncated at {MAX_TOKENS} output tokens; "
+              f"cards after the cut-off are lost.")
+
+    response_text = "".join(text_parts)
+    cards = parser.cards
+
+    if not cards:
+        # Fall back to decoding the whole array at once
+        array_text = _find_json_array(response_text)
+        if array_text is None:
+            print(f"  Warning: Could not parse JSON from response for '{chunk_title}', skipping.")
+            return []
+
+        try:
+            cards = json_loads(array_text)
+        except json.JSONDecodeError:
+            print(f"  Warning: Invalid JSON for '{chunk_title}', skipping.")
+            return []
+    elif parser.invalid:
+        print(f"  Warning: Skipped {parser.invalid} invalid card(s) for '{chunk_title}'.")
+
+    # One delta can complete several cards, and the fallback path parses them all at once
+    if max_cards:
+        cards = cards[:max_cards]
+
+    if cache_dir:
+        _cache_put(cache_dir, key, {"response": response_text, "cards": cards})
+    if semantic_cache and source_text is not None and cards:
+        semantic_cache.add(model, source_text, cards, max_cards)
+    return cards
+
+
+def generate_flashcards(client: anthropic.Anthropic, model: str, title: str, text: str, max_cards: int | None,
+                        max_workers: int = 1, cache_dir: Path | None = None,
+                        semantic_cache: SemanticCache | None = None,
+                        max_chunk_tokens: int = MAX_CHUNK_TOKENS) -> list[dict]:
+    """Send a section to Claude and parse flashcard JSON response."""
+    chunks = chunk_text_by_tokens(client, model, text, max_chunk_tokens, cache_dir=cache_dir)
+    chunk_titles = [
+        title if len(chunks) == 1 else f"{title} (part {i + 1}/{len(chunks)})"
+        for i in range(len(chunks))
+    ]
+
+    def process_chunk(chunk_title: str, chunk: str, remaining: int | None = None) -> list[dict]:
         prompt = USER_PROMPT_TEMPLATE.format(title=chunk_title, text=chunk)
+        if remaining:
+            prompt += f"\n\nGenerate at most {remaining} flashcards."
+        return generate_chunk_flashcards(
+            client, model, chunk_title, prompt, cache_dir, remaining, semantic_cache, chunk,
+        )
+
+    # Without a card limit the chunks are independent and can be sent concurrently
+    if not max_cards and len(chunks) > 1 and max_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [
+                executor.submit(process_chunk, chunk_title, chunk)
+                for chunk_title, chunk in zip(chunk_titles, chunks)
+            ]
+            try:
+                return [card for future in futures for card in future.result()]
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    all_cards = []
+    for chunk_title, chunk in zip(chunk_titles, chunks):
+        remaining = None
         if max_cards:
             remaining = max_cards - len(all_cards)
             if remaining <= 0:
                 break
-            prompt += f"\n\nGenerate at most {remaining} flashcards."
 
-        response = client.messages.create(
-            model=model,
-            max_tokens=4096,
-            system=SYSTEM_PROMPT,
-            messages=[{"role": "user", "content": prompt}],
-        )
+        all_cards.extend(process_chunk(chunk_title, chunk, remaining))
 
-        response_text = response.content[0].text
+    return all_cards
 
-        # Extract JSON array from the response
-        match = re.search(r"\[.*\]", response_text, re.DOTALL)
-        if not match:
-            print(f"  Warning: Could not parse JSON from response for '{chunk_title}', skipping.")
-            continue
 
+def _parse_section_cards(s: str) -> dict[str, list]:
+    """Parse the section-number -> cards object from a batched response.
+
+    Keys are read one at a time, so when the response was cut off the
+    sections whose card arrays were completed are still returned.
+    """
+    object_text = _find_json_object(s)
+    if object_text is not None:
         try:
-            cards = json.loads(match.group())
-            all_cards.extend(cards)
+            return json_loads(object_text)
         except json.JSONDecodeError:
-            print(f"  Warning: Invalid JSON for '{chunk_title}', skipping.")
+            pass
+
+    # Incomplete or invalid object: recover the complete "key": [...] pairs
+    by_number = {}
+    start = s.find("{")
+    while start != -1:
+        pos = start + 1
+        while True:
+            key_match = _SECTION_KEY_RE.match(s, pos)
+            if not key_match or s[key_match.end():key_match.end() + 1] != "[":
+                break
+            end = _match_json(s, key_match.end())
+            if end is None:
+                break
+            try:
+                by_number[key_match.group(1)] = json_loads(s[key_match.end():end])
+            except json.JSONDecodeError:
+                pass
+            pos = end
+        if by_number:
+            break
+        start = s.find("{", start + 1)
+    return by_number
+
+
+def generate_batch_flashcards(client: anthropic.Anthropic, model: str, sections: list[dict], max_cards: int | None,
+                              cache_dir: Path | None = None,
+                              semantic_cache: SemanticCache | None = None) -> list[list[dict] | None]:
+    """Send several small sections in one request and parse the cards for each.
+
+    Sections the semantic cache already covers are left out of the request.
+    Returns one card list per section, or None for sections that still need
+    a request of their own.
+    """
+    def batch_prompt(indices: list[int]) -> str:
+        numbered = "\n\n".join(
+            BATCH_SECTION_TEMPLATE.format(number=n, title=sections[i]["title"], text=sections[i]["text"])
+            for n, i in enumerate(indices, 1)
+        )
+        prompt = BATCH_PROMPT_TEMPLATE.format(count=len(indices), sections=numbered)
+        if max_cards:
+            prompt += f"\n\nGenerate at most {max_cards} flashcards per section."
+        return prompt
+
+    results = [None] * len(sections)
+    todo = list(range(len(sections)))
+    prompt = batch_prompt(todo)
+
+    # The exact cache for the whole pack wins over semantic matches
+    cached = _cache_get(cache_dir, _cache_key(model, prompt)) if cache_dir else None
+    if cached is None and semantic_cache:
+        for i in todo:
+            cards = semantic_cache.lookup(model, sections[i]["text"], max_cards)
+            if cards is not None:
+                results[i] = cards[:max_cards] if max_cards else cards
+        if any(cards is not None for cards in results):
+            todo = [i for i in todo if results[i] is None]
+            # A single remaining section goes through the per-section path
+            if len(todo) < 2:
+                return results
+            prompt = batch_prompt(todo)
+            cached = _cache_get(cache_dir, _cache_key(model, prompt)) if cache_dir else None
+
+    if cached is not None:
+        for i, cards in zip(todo, cached["cards"]):
+            results[i] = cards
+        return results
+
+    with client.messages.stream(
+        model=model,
+        max_tokens=MAX_TOKENS,
+        system=SYSTEM_BLOCKS,
+        messages=[{"role": "user", "content": prompt}],
+    ) as stream:
+        response_text = "".join(stream.text_stream)
+        stop_reason = stream.get_final_message().stop_reason
+
+    by_number = _parse_section_cards(response_text)
+    generated = []
+    for n, i in enumerate(todo, 1):
+        cards = by_number.get(str(n))
+        if isinstance(cards, list):
+            results[i] = cards[:max_cards] if max_cards else cards
+        generated.append(results[i])
+
+    if stop_reason == "max_tokens":
+        done = sum(cards is not None for cards in generated)
+        print(f"  Warning: Combined response was truncated; recovered {done} of {len(todo)} section(s).")
+
+    if any(cards is not None for cards in generated):
+        if cache_dir:
+            _cache_put(cache_dir, _cache_key(model, prompt), {"response": response_text, "cards": generated})
+        if semantic_cache:
+            for i in todo:
+                if results[i]:
+                    semantic_cache.add(model, sections[i]["text"], results[i], max_cards)
+    return results
+
+
+def generate_pack_flashcards(client: anthropic.Anthropic, model: str, sections: list[dict], max_cards: int | None,
+                             max_workers: int = 1, cache_dir: Path | None = None,
+                             semantic_cache: SemanticCache | None = None,
+                             max_chunk_tokens: int = MAX_CHUNK_TOKENS) -> list[list[dict]]:
+    """Generate flashcards for a pack of sections, returning one card list per section."""
+    if len(sections) > 1:
+        results = generate_batch_flashcards(client, model, sections, max_cards, cache_dir, semantic_cache)
+    else:
+        results = [None]
 
-    return all_cards
+    # Single sections, and any the batched response left out, go through the per-section path
+    for i, section in enumerate(sections):
+        if results[i] is None:
+            results[i] = generate_flashcards(
+                client, model, section["title"], section["text"], max_cards, max_workers, cache_dir, semantic_cache,
+                max_chunk_tokens,
+            )
+    return results
 
 
 def sanitize_tag(title: str) -> str:
     """Convert a section title into a valid Anki tag (no spaces)."""
-    tag = re.sub(r"[^\w\-]", "_", title)
-    tag = re.sub(r"_+", "_", tag).strip("_")
+    tag = _TAG_INVALID_RE.sub("_", title)
+    tag = _TAG_COLLAPSE_RE.sub("_", tag).strip("_")
     return tag
 
 
-def write_tsv(cards: list[dict], output_path: str):
-    """Write flashcards to a TSV file importable by Anki."""
-    with open(output_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter="\t")
-        writer.writerow(["Front", "Back", "Tags"])
-        for card in cards:
-            writer.writerow([card["front"], card["back"], card.get("tag", "")])
+def write_cards(writer, cards: list[dict]):
+    """Append flashcards to an Anki-importable TSV writer."""
+    writer.writerows((card["front"], card["back"], card.get("tag", "")) for card in cards)
 
 
 def main():
@@ -204,6 +865,23 @@ def main():
     parser.add_argument("--api-key", help="Anthropic API key (or set ANTHROPIC_API_KEY env var)")
     parser.add_argument("--model", default="claude-sonnet-4-5-20250929", help="Claude model to use")
     parser.add_argument("--max-cards", type=int, help="Maximum flashcards per section")
+    parser.add_argument("--max-tokens-per-chunk", type=int, default=MAX_CHUNK_TOKENS,
+                        help=f"Split sections longer than this many tokens into chunks (default: {MAX_CHUNK_TOKENS})")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Number of concurrent Claude API requests (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--cache-dir", type=Path, default=DEFAULT_CACHE_DIR,
+                        help=f"Directory for cached Claude responses (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API, ignoring cached responses")
+    parser.add_argument("--pack-chars", type=int, default=MAX_PACK_CHARS,
+                        help=f"Combine consecutive small sections into one request up to this many characters; "
+                             f"0 disables (default: {MAX_PACK_CHARS})")
+    parser.add_argument("--semantic-cache", action="store_true",
+                        help="Reuse flashcards for near-identical text (requires sentence-transformers)")
+    parser.add_argument("--dedupe-threshold", type=float,
+                        help="Also drop cards whose question is at least this similar to an earlier one, "
+                             f"e.g. {SUGGESTED_DEDUPE_THRESHOLD} (requires sentence-transformers)")
+    parser.add_argument("--semantic-threshold", type=float, default=DEFAULT_SEMANTIC_THRESHOLD,
+                        help=f"Cosine similarity needed for a semantic cache hit (default: {DEFAULT_SEMANTIC_THRESHOLD})")
     args = parser.parse_args()
 
     if not os.path.isfile(args.pdf):
@@ -215,6 +893,31 @@ def main():
         print("Error: Provide an API key via --api-key or ANTHROPIC_API_KEY env var.")
         sys.exit(1)
 
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1.")
+        sys.exit(1)
+
+    if args.max_tokens_per_chunk <= 2 * CHUNK_OVERLAP_TOKENS:
+        print(f"Error: --max-tokens-per-chunk must be greater than {2 * CHUNK_OVERLAP_TOKENS}.")
+        sys.exit(1)
+
+    if args.semantic_cache and args.no_cache:
+        print("Error: --semantic-cache cannot be combined with --no-cache.")
+        sys.exit(1)
+
+    cache_dir = None if args.no_cache else args.cache_dir.expanduser()
+    semantic_cache = None
+    if args.semantic_cache:
+        try:
+            semantic_cache = SemanticCache(cache_dir, args.semantic_threshold)
+        except ImportError:
+            print("Error: --semantic-cache requires sentence-transformers (pip install sentence-transformers).")
+            sys.exit(1)
+    try:
+        deduplicator = CardDeduplicator(args.dedupe_threshold)
+    except ImportError:
+        print("Error: --dedupe-threshold requires sentence-transformers (pip install sentence-transformers).")
+        sys.exit(1)
     output_path = args.output or os.path.splitext(args.pdf)[0] + "_flashcards.tsv"
 
     # Step 1: Extract sections
@@ -222,27 +925,81 @@ def main():
     sections = extract_sections(args.pdf)
     print(f"Found {len(sections)} section(s).\n")
 
-    # Step 2: Generate flashcards per section
-    client = anthropic.Anthropic(api_key=api_key)
-    all_cards = []
-
-    for i, section in enumerate(sections, 1):
-        title = section["title"]
-        print(f"[{i}/{len(sections)}] Generating flashcards for: {title} ({len(section['text'])} chars)")
-
-        cards = generate_flashcards(client, args.model, title, section["text"], args.max_cards)
-        tag = sanitize_tag(title)
-        for card in cards:
-            card["tag"] = tag
-
-        all_cards.extend(cards)
-        print(f"  -> {len(cards)} cards generated.\n")
+    # Step 2: Generate flashcards per section (concurrently; the work is network-bound)
+    # The client retries rate-limit and overload errors with exponential backoff.
+    # A shared pooled (HTTP/2 when available) connection avoids a TLS handshake per request
+    http_client = anthropic.DefaultHttpxClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT),
+        limits=httpx.Limits(
+            max_keepalive_connections=max(MAX_KEEPALIVE_CONNECTIONS, args.concurrency),
+            max_connections=max(MAX_CONNECTIONS, args.concurrency),
+        ),
+    )
+    client = anthropic.Anthropic(api_key=api_key, max_retries=MAX_RETRIES, http_client=http_client)
+    packs = _pack_sections(sections, args.pack_chars)
+    # Spare workers go to splitting large sections into concurrent chunk requests
+    chunk_workers = max(1, args.concurrency // len(packs))
+    # Finished sections wait here until every earlier section has been written
+    pending = {}
+    next_section = 0
+    total_cards = 0
+    duplicates = 0
+
+    print(f"Generating flashcards in {len(packs)} request group(s), up to {args.concurrency} at a time...")
+    # Step 3: Write output as sections complete, so progress survives a crash
+    with (
+        open(output_path, "w", newline="", encoding="utf-8") as f,
+        concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor,
+    ):
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["Front", "Back", "Tags"])
 
-    # Step 3: Write output
-    if all_cards:
-        write_tsv(all_cards, output_path)
-        print(f"Done! {len(all_cards)} flashcards written to: {output_path}")
+        try:
+            futures = {}
+            for pack in packs:
+                future = executor.submit(
+                    generate_pack_flashcards, client, args.model, [sections[i] for i in pack], args.max_cards,
+                    chunk_workers, cache_dir, semantic_cache, args.max_tokens_per_chunk,
+                )
+                futures[future] = pack
+
+            for future in concurrent.futures.as_completed(futures):
+                pack = futures[future]
+                for i, cards in zip(pack, future.result()):
+                    title = sections[i]["title"]
+                    tag = sanitize_tag(title)
+                    for card in cards:
+                        card["tag"] = tag
+
+                    pending[i] = cards
+                    print(f"[{i + 1}/{len(sections)}] {title} ({len(sections[i]['text'])} chars) -> {len(cards)} cards generated.")
+
+                # Keep the output in document order regardless of completion order
+                while next_section in pending:
+                    cards = pending.pop(next_section)
+                    unique = deduplicator.filter(cards)
+                    duplicates += len(cards) - len(unique)
+                    cards = unique
+                    write_cards(writer, cards)
+                    total_cards += len(cards)
+                    next_section += 1
+                f.flush()
+        except BaseException:
+            # Fail fast (errors and Ctrl-C) instead of sending every queued request first
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if semantic_cache:
+        semantic_cache.save()
+
+    print()
+    if duplicates:
+        print(f"Dropped {duplicates} duplicate flashcard(s).")
+    if total_cards:
+        print(f"Done! {total_cards} flashcards written to: {output_path}")
     else:
+        os.remove(output_path)
         print("No flashcards were generated.")
 
 